@@ -0,0 +1,101 @@
+"""精簡 token 的 diff 編碼：略過純空白變更、收合上下文、使用簡短標頭"""
+import os
+import re
+
+# compact 標頭中的文件狀態代碼（GitHub PR files API 的 status）
+COMPACT_STATUS_CODES = {
+    'added': 'A', 'removed': 'D', 'modified': 'M', 'renamed': 'R',
+    'copied': 'C', 'changed': 'T', 'unchanged': 'U',
+}
+# 縮排具有語意的副檔名
+INDENTATION_SENSITIVE_EXTENSIONS = ('.py', '.pyi', '.yml', '.yaml', '.coffee', '.pug', '.sass', '.mk')
+
+
+def estimate_tokens(text):
+    """粗估文字的 token 數（約每 4 個字符 1 個 token）"""
+    return (len(text) + 3) // 4
+
+
+def split_patch_hunks(patch):
+    """把 patch 拆成 [(old_start, new_start, lines)]，lines 保留 +/-/空白 前綴"""
+    hunks = []
+    for raw_line in (patch or '').split('\n'):
+        match = re.match(r'^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@', raw_line)
+        if match:
+            hunks.append((int(match.group(1)), int(match.group(2)), []))
+        elif hunks and not raw_line.startswith('\\'):
+            hunks[-1][2].append(raw_line)
+    return hunks
+
+
+def is_indentation_sensitive(filename):
+    """縮排具有語意的文件（Python、YAML、Makefile 等），縮排變更不可視為純空白變更"""
+    return filename.endswith(INDENTATION_SENSITIVE_EXTENSIONS) or os.path.basename(filename) == 'Makefile'
+
+
+def is_whitespace_only_hunk(lines, filename=''):
+    """hunk 的刪除行與新增行只差在行首/行尾空白（或空行）
+
+    行內的空白（例如字串內容）一律視為有意義；縮排敏感的文件只忽略行尾空白。
+    """
+    normalize = str.rstrip if is_indentation_sensitive(filename) else str.strip
+    removed = [normalize(line[1:]) for line in lines if line.startswith('-')]
+    added = [normalize(line[1:]) for line in lines if line.startswith('+')]
+    return [line for line in removed if line] == [line for line in added if line]
+
+
+def compact_hunk(old_start, new_start, lines, context=1):
+    """只保留變更行及其前後 context 行；被省略的上下文以新的 @@ 標頭切段，行號仍可推算"""
+    changed = [i for i, line in enumerate(lines) if line.startswith(('+', '-'))]
+    keep = set()
+    for i in changed:
+        keep.update(range(max(0, i - context), min(len(lines), i + context + 1)))
+
+    output = []
+    old_line, new_line = old_start, new_start
+    previous_kept = None
+    for i, line in enumerate(lines):
+        if i in keep:
+            if previous_kept != i - 1:
+                output.append(f"@@ -{old_line} +{new_line} @@")
+            output.append(line)
+            previous_kept = i
+        if line.startswith('+'):
+            new_line += 1
+        elif line.startswith('-'):
+            old_line += 1
+        else:
+            old_line += 1
+            new_line += 1
+    return output
+
+
+def encode_file_compact(file_data, context=1):
+    """以精簡格式編碼單一文件；回傳 (文字, 略過原因)，兩者其一為 None"""
+    filename = file_data['filename']
+    status = file_data['status']
+    additions = file_data.get('additions', 0)
+    deletions = file_data.get('deletions', 0)
+    patch = file_data.get('patch')
+
+    if status == 'renamed' and additions + deletions == 0:
+        return None, 'rename only'
+
+    header = f"## {filename} {COMPACT_STATUS_CODES.get(status, status)} +{additions}/-{deletions}"
+    if 'previous_filename' in file_data:
+        header += f" <- {file_data['previous_filename']}"
+
+    if status == 'removed':
+        return header, None  # 被刪除的內容不需要審查
+    if not patch:
+        return header + " (no patch)", None
+
+    body = []
+    for old_start, new_start, lines in split_patch_hunks(patch):
+        if is_whitespace_only_hunk(lines, filename):
+            continue
+        body.extend(compact_hunk(old_start, new_start, lines, context))
+
+    if not body:
+        return None, 'whitespace only'
+    return header + "\n" + "\n".join(body), None
@@ -0,0 +1,85 @@
+"""PR diff 的可留言位置索引，用於在本地驗證 review 留言的錨點"""
+import re
+
+
+def parse_patch_lines(patch):
+    """解析 unified diff patch，回傳 (side, line, kind) 列表
+
+    side 為 GitHub review API 的 LEFT（base）或 RIGHT（head），
+    kind 為 'add'、'del' 或 'context'。
+    """
+    lines = []
+    old_line = new_line = 0
+    in_hunk = False
+
+    for raw_line in (patch or '').split('\n'):
+        if raw_line.startswith('@@'):
+            match = re.match(r'^@@ -(\d+)(?:,\d+)? \+(\d+)(?:,\d+)? @@', raw_line)
+            if not match:
+                in_hunk = False
+                continue
+            old_line, new_line = int(match.group(1)), int(match.group(2))
+            in_hunk = True
+        elif not in_hunk or raw_line.startswith('\\'):
+            continue  # hunk 之外的標頭，或 "\ No newline at end of file"
+        elif raw_line.startswith('+'):
+            lines.append(('RIGHT', new_line, 'add'))
+            new_line += 1
+        elif raw_line.startswith('-'):
+            lines.append(('LEFT', old_line, 'del'))
+            old_line += 1
+        else:
+            lines.append(('LEFT', old_line, 'context'))
+            lines.append(('RIGHT', new_line, 'context'))
+            old_line += 1
+            new_line += 1
+
+    return lines
+
+
+def build_diff_position_index(files):
+    """從 PR 文件列表建立可留言位置索引: {path: {side: {line: kind}}}"""
+    index = {}
+    for file_data in files:
+        positions = {'LEFT': {}, 'RIGHT': {}}
+        for side, line, kind in parse_patch_lines(file_data.get('patch')):
+            positions[side][line] = kind
+        index[file_data['filename']] = positions
+
+    commentable = sum(len(p['RIGHT']) + len(p['LEFT']) for p in index.values())
+    print(f"🗂️  Diff 位置索引: {len(index)} 個文件，{commentable} 個可留言位置")
+    return index
+
+
+def resolve_comment_anchor(index, file_path, line_number, side='RIGHT', snap_lines=3):
+    """在本地判斷留言錨點，回傳 {'path', 'line', 'side'} 或 None（改用一般留言）
+
+    行號在 diff 中時直接使用；否則對齊到 snap_lines 行內最近的變更行。
+    """
+    if not file_path or not line_number:
+        return None
+
+    # 模型有時會帶上 ./ 或 a/、b/ 前綴
+    path = file_path
+    if path not in index:
+        for prefix in ('./', 'a/', 'b/'):
+            if path.startswith(prefix) and path[len(prefix):] in index:
+                path = path[len(prefix):]
+                break
+        else:
+            return None
+
+    positions = index[path][side]
+    if line_number in positions:
+        return {'path': path, 'line': line_number, 'side': side}
+
+    changed_lines = [line for line, kind in positions.items() if kind != 'context']
+    if not changed_lines:
+        return None
+
+    nearest = min(changed_lines, key=lambda line: (abs(line - line_number), line))
+    if abs(nearest - line_number) > snap_lines:
+        return None
+
+    print(f"  ↪️  行號 {file_path}:{line_number} 對齊到變更行 {nearest}")
+    return {'path': path, 'line': nearest, 'side': side}
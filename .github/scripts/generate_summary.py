@@ -1,9 +1,22 @@
+import argparse
 import os
 import requests
 import json
 import google.generativeai as genai
-from datetime import datetime
+from datetime import datetime, timedelta
 import base64
+import re
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from diff_encoding import encode_file_compact, estimate_tokens
+from diff_index import build_diff_position_index, resolve_comment_anchor
+from prompt_cache import LocalPromptCache, prefix_key
+from sharding import merge_shard_findings, partition_files
+from symbol_index import build_symbol_context, update_symbol_index
 
 # --- 環境變數讀取 ---
 GITHUB_TOKEN = os.environ['GITHUB_TOKEN']
@@ -11,6 +24,108 @@ REPO = os.environ['GITHUB_REPOSITORY']
 PR_NUMBER = os.environ['PR_NUMBER']
 GEMINI_API_KEY = os.environ['GEMINI_API_KEY']
 GEMINI_MODEL = os.environ.get('GEMINI_MODEL', 'gemini-2.5-flash-lite-preview-06-17')
+# 提示詞前綴快取: auto（優先使用 Gemini context caching）、local（本地替身）、off
+PROMPT_CACHE_MODE = os.environ.get('PROMPT_CACHE_MODE', 'auto')
+PROMPT_CACHE_TTL_MINUTES = int(os.environ.get('PROMPT_CACHE_TTL_MINUTES', '10'))
+# Gemini 可快取內容的最小 token 數，前綴不足時不建立遠端快取
+PROMPT_CACHE_MIN_TOKENS = int(os.environ.get('PROMPT_CACHE_MIN_TOKENS', '1024'))
+# 共用同一前綴的階段1 呼叫（分片）數量達到此值，建立快取的額外請求與儲存費用才划算
+PROMPT_CACHE_MIN_CALLS = int(os.environ.get('PROMPT_CACHE_MIN_CALLS', '4'))
+# 由 --create-prompt-cache（或本機分片的父行程）建立、供各分片共用的 Gemini 快取名稱
+PROMPT_CACHE_NAME = os.environ.get('PROMPT_CACHE_NAME', '')
+# 每次分析都會一併送出的共用倉庫上下文（逗號分隔）
+REVIEW_CONTEXT_FILES = [
+    path.strip()
+    for path in os.environ.get('REVIEW_CONTEXT_FILES', 'src/firebase.js,src/App.js').split(',')
+    if path.strip()
+]
+# 模型給的行號不在 diff 中時，最多往附近幾行對齊到變更行
+DIFF_ANCHOR_SNAP_LINES = int(os.environ.get('DIFF_ANCHOR_SNAP_LINES', '3'))
+# Diff 編碼模式: full（完整格式，含裝飾標頭與完整上下文）或 compact（精簡 token）
+DIFF_ENCODING = os.environ.get('DIFF_ENCODING', 'full')
+# compact 模式下每段變更前後保留的上下文行數
+COMPACT_CONTEXT_LINES = int(os.environ.get('COMPACT_CONTEXT_LINES', '1'))
+# 整次執行的時間預算（秒），需小於 workflow 的 timeout-minutes，以確保結果能在被終止前發佈
+RUN_DEADLINE_SECONDS = float(os.environ.get('RUN_DEADLINE_SECONDS', '480'))
+# 粗估模型每秒可處理的 diff 字符數，用來決定剩餘預算能分析多少文件
+ANALYSIS_CHARS_PER_SECOND = int(os.environ.get('ANALYSIS_CHARS_PER_SECOND', '2000'))
+# 送進模型的 diff 長度上限（unified diff 格式的截斷長度，也是各格式中最小的上限）
+MAX_DIFF_CHARS = 100000
+# 低優先度文件: 依賴鎖定檔、IDE 設定、文件與靜態資源，預算不足時最先略過
+LOW_PRIORITY_PATTERNS = [
+    r'(^|/)package-lock\.json$', r'(^|/)yarn\.lock$', r'\.lock$', r'(^|/)\.idea/',
+    r'\.(md|txt|svg|png|jpe?g|gif|ico)$', r'\.min\.(js|css)$', r'(^|/)public/',
+]
+# 符號索引: 在已 checkout 的倉庫上建立，並以 blob SHA 快取於跨次執行之間
+REPO_ROOT = os.environ.get('GITHUB_WORKSPACE', os.getcwd())
+SYMBOL_INDEX_CACHE = os.environ.get(
+    'SYMBOL_INDEX_CACHE', os.path.expanduser('~/.cache/pr-review/symbol_index.json')
+)
+
+
+class RunDeadline:
+    """整次執行的時間預算，依序分配給 fetch / context / analysis / posting 各階段
+
+    每個階段的截止時間為總截止時間扣除後續階段的保留額度，
+    因此前面階段未用完的時間會順延給後面的階段，posting 永遠保有自己的額度。
+    分片不發佈留言，以 SHARD_PHASES 建立時不保留 posting 的額度。
+    """
+
+    PHASES = ('fetch', 'context', 'analysis', 'posting')
+    SHARD_PHASES = ('fetch', 'context', 'analysis')
+    PHASE_SHARES = {'fetch': 0.15, 'context': 0.1, 'analysis': 0.5, 'posting': 0.25}
+
+    def __init__(self, total_seconds, phases=PHASES):
+        self.phases = phases
+        self.total_seconds = total_seconds
+        self.deadline = time.monotonic() + total_seconds
+        self.phase = None
+        self.phase_started = None
+        self.phase_deadline = self.deadline
+        self.skipped = []
+
+    def remaining(self):
+        return max(0.0, self.deadline - time.monotonic())
+
+    def phase_remaining(self):
+        return max(0.0, self.phase_deadline - time.monotonic())
+
+    def _reserve_after(self, phase):
+        later = self.phases[self.phases.index(phase) + 1:]
+        return sum(self.PHASE_SHARES[p] for p in later) * self.total_seconds
+
+    def start_phase(self, phase):
+        self.phase = phase
+        self.phase_started = time.monotonic()
+        self.phase_deadline = max(time.monotonic(), self.deadline - self._reserve_after(phase))
+        print(f"⏱️  階段 {phase}: 預算 {self.phase_remaining():.0f} 秒（總剩餘 {self.remaining():.0f} 秒）")
+
+    def budget_for(self, phase):
+        """預估 phase 可用的秒數：phase 的截止時間減去目前階段預期還會用掉的時間
+
+        中間的階段只在用到時才佔用時間，因此不預先扣除它們的額度。
+        """
+        now = time.monotonic()
+        expected = 0.0
+        if self.phase and self.phase != phase:
+            share = self.PHASE_SHARES[self.phase] * self.total_seconds
+            expected = min(self.phase_remaining(), max(0.0, share - (now - self.phase_started)))
+        return max(0.0, self.deadline - self._reserve_after(phase) - now - expected)
+
+    def has_time_for(self, seconds):
+        return self.phase_remaining() >= seconds
+
+    def request_timeout(self, default=30):
+        """HTTP 請求的逾時秒數，不超過整次執行的剩餘時間"""
+        return max(1.0, min(default, self.remaining()))
+
+    def skip(self, item):
+        # 同一項目只記錄一次（例如合併時各分片都回報的文件上限）
+        if item in self.skipped:
+            return
+        self.skipped.append(item)
+        print(f"⏭️  略過: {item}")
+
 
 # --- API 設定 ---
 GITHUB_API_URL = "https://api.github.com"
@@ -22,45 +137,88 @@ GITHUB_HEADERS = {
 # 設定 Gemini API 金鑰
 genai.configure(api_key=GEMINI_API_KEY)
 
+RUN_DEADLINE = RunDeadline(RUN_DEADLINE_SECONDS)
+
+# PR files API 最多回傳的文件數
+GITHUB_PR_FILES_LIMIT = 3000
+# 已讀取的 PR 文件列表，避免每個階段重新逐頁請求
+_PR_FILES = None
+
 
 def get_pr_files():
-    """獲取 PR 中所有變更的文件列表"""
+    """獲取 PR 中所有變更的文件列表（逐頁讀取，同一次執行只請求一次）"""
+    global _PR_FILES
+    if _PR_FILES is not None:
+        return _PR_FILES
+
+    files = []
     url = f"{GITHUB_API_URL}/repos/{REPO}/pulls/{PR_NUMBER}/files"
-    response = requests.get(url, headers=GITHUB_HEADERS)
-    response.raise_for_status()
-    return response.json()
+    params = {'per_page': 100}
+    while url:
+        response = requests.get(url, headers=GITHUB_HEADERS, params=params,
+                                timeout=RUN_DEADLINE.request_timeout())
+        response.raise_for_status()
+        files.extend(response.json())
+        # 下一頁的 URL 已包含查詢參數
+        url = response.links.get('next', {}).get('url')
+        params = None
+
+    # GitHub 最多只列出 3000 個文件，其餘無法分析
+    if len(files) >= GITHUB_PR_FILES_LIMIT:
+        changed_files = get_pr_basic_info().get('changed_files', len(files))
+        if changed_files > len(files):
+            RUN_DEADLINE.skip(
+                f"超出 GitHub {GITHUB_PR_FILES_LIMIT} 個文件上限，另有 {changed_files - len(files)} 個文件未列出"
+            )
+
+    _PR_FILES = files
+    return files
 
 
 def get_pr_basic_info():
     """獲取 PR 基本資訊"""
     pr_url = f"{GITHUB_API_URL}/repos/{REPO}/pulls/{PR_NUMBER}"
-    pr_response = requests.get(pr_url, headers=GITHUB_HEADERS)
+    pr_response = requests.get(pr_url, headers=GITHUB_HEADERS, timeout=RUN_DEADLINE.request_timeout())
     pr_response.raise_for_status()
     return pr_response.json()
 
 
+def truncate_diff(diff, limit, label, files=()):
+    """截斷過長的 diff，並把內容被截掉的文件記錄為略過，避免摘要誤報為已全部審查"""
+    print(f"⚠️  Diff 內容過長（{label}），截斷至 {limit} 字符...")
+    kept = diff[:limit]
+    dropped = [f['filename'] for f in files if f['filename'] not in kept]
+    for filename in dropped:
+        RUN_DEADLINE.skip(f"文件: {filename}（diff 已截斷）")
+    if not dropped:
+        RUN_DEADLINE.skip(f"超過 {limit} 字符的 diff 內容（已截斷）")
+    return kept + f"\n\n⚠️ 內容已截斷（{label}）"
+
+
 def get_enhanced_pr_diff():
     """取得 Pull Request 的完整 diff 內容 - 增強版，顯示更大範圍"""
     try:
         pr_data = get_pr_basic_info()
         print(f"PR 標題: {pr_data.get('title', 'N/A')}")
 
+        if DIFF_ENCODING == 'compact':
+            return get_compact_pr_diff(pr_data)
+
         # 方法1: 嘗試獲取完整的 unified diff 格式
         print("🔍 嘗試獲取完整 unified diff...")
         diff_headers = GITHUB_HEADERS.copy()
         diff_headers['Accept'] = 'application/vnd.github.v3.diff'
         
         diff_url = f"{GITHUB_API_URL}/repos/{REPO}/pulls/{PR_NUMBER}"
-        diff_response = requests.get(diff_url, headers=diff_headers)
+        diff_response = requests.get(diff_url, headers=diff_headers, timeout=RUN_DEADLINE.request_timeout())
         
         if diff_response.status_code == 200 and diff_response.text.strip():
             full_unified_diff = diff_response.text
             print(f"✅ 成功獲取完整 unified diff，長度: {len(full_unified_diff)}")
             
             # 增加截斷限制到 100K
-            if len(full_unified_diff) > 100000:
-                print(f"⚠️  Diff 內容過長，進行截斷...")
-                return full_unified_diff[:100000] + "\n\n⚠️ 內容已截斷（unified diff 格式）"
+            if len(full_unified_diff) > MAX_DIFF_CHARS:
+                return truncate_diff(full_unified_diff, MAX_DIFF_CHARS, 'unified diff 格式', get_pr_files())
             
             # 添加 PR 基本資訊到 diff 開頭
             enhanced_diff = f"""Pull Request: {pr_data.get('title', '')}
@@ -88,10 +246,10 @@ UNIFIED DIFF CONTENT:
         return get_pr_diff_fallback()
 
 
-def get_enhanced_file_by_file_diff(pr_data):
+def get_enhanced_file_by_file_diff(pr_data, files=None):
     """增強版的逐文件 diff 處理，包含更多上下文"""
     try:
-        files = get_pr_files()
+        files = get_pr_files() if files is None else files
         print(f"實際獲取到 {len(files)} 個變更文件")
 
         if not files:
@@ -134,10 +292,14 @@ ENHANCED FILE-BY-FILE DIFF:
                 file_diff += file_data['patch']
                 file_diff += "\n"
 
-            # 對於小的變更，嘗試獲取更多上下文
+            # 對於小的變更，嘗試獲取更多上下文（可選，時間預算不足時略過）
             if additions + deletions <= 20 and status in ['modified', 'added']:
-                print(f"  └─ 嘗試獲取 {filename} 的完整內容上下文...")
-                file_context = get_file_full_context(filename, pr_data)
+                if RUN_DEADLINE.has_time_for(10):
+                    print(f"  └─ 嘗試獲取 {filename} 的完整內容上下文...")
+                    file_context = get_file_full_context(filename, pr_data)
+                else:
+                    RUN_DEADLINE.skip(f"完整上下文: {filename}")
+                    file_context = None
                 if file_context:
                     file_diff += f"\n--- FULL FILE CONTEXT ---\n"
                     file_diff += f"Base SHA: {pr_data['base']['sha'][:8]}\n"
@@ -171,8 +333,7 @@ ENHANCED FILE-BY-FILE DIFF:
 
         # 增加總長度限制到 150K
         if len(full_diff) > 150000:
-            print(f"⚠️  Enhanced diff 內容過長，進行截斷...")
-            return full_diff[:150000] + "\n\n⚠️ 內容已截斷（增強版格式）"
+            return truncate_diff(full_diff, 150000, '增強版格式', files)
 
         return full_diff
 
@@ -181,44 +342,105 @@ ENHANCED FILE-BY-FILE DIFF:
         return get_pr_diff_fallback()
 
 
+def get_compact_pr_diff(pr_data, files=None):
+    """精簡 token 的 diff 編碼：略過純空白與純改名的變更、收合上下文、使用簡短標頭"""
+    try:
+        files = get_pr_files() if files is None else files
+        if not files:
+            return "No files changed in this PR."
+
+        sections = [
+            f"PR: {pr_data.get('title', '')} | {pr_data.get('base', {}).get('ref', 'N/A')}"
+            f"<-{pr_data.get('head', {}).get('ref', 'N/A')} | {len(files)} files "
+            f"+{pr_data.get('additions', 0)}/-{pr_data.get('deletions', 0)}"
+        ]
+        baseline_tokens = 0
+        skipped = []
+
+        for file_data in files:
+            # 以完整格式（裝飾標頭 + 原始 patch）作為節省量的比較基準
+            baseline_tokens += estimate_tokens(
+                f"\n{'=' * 60}\n📁 File: {file_data['filename']}\n📊 Status: {file_data['status']}\n"
+                f"📈 Changes: +{file_data.get('additions', 0)}/-{file_data.get('deletions', 0)}\n"
+                f"{'=' * 60}\n\n--- STANDARD PATCH ---\n{file_data.get('patch') or ''}\n"
+            )
+            encoded, reason = encode_file_compact(file_data, COMPACT_CONTEXT_LINES)
+            if encoded is None:
+                skipped.append(f"{file_data['filename']} ({reason})")
+            else:
+                sections.append(encoded)
+
+        if skipped:
+            sections.append("skipped: " + ", ".join(skipped))
+
+        compact_diff = "\n".join(sections)
+        compact_tokens = estimate_tokens(compact_diff)
+        saved = max(0, baseline_tokens - compact_tokens)
+        ratio = saved * 100 // baseline_tokens if baseline_tokens else 0
+        print(f"🪙 精簡編碼: 約 {baseline_tokens} → {compact_tokens} tokens（節省 {saved}，{ratio}%），略過 {len(skipped)} 個文件")
+
+        # 與增強版相同的總長度限制
+        if len(compact_diff) > 150000:
+            return truncate_diff(compact_diff, 150000, '精簡格式', files)
+
+        return compact_diff
+
+    except Exception as e:
+        print(f"❌ 獲取精簡 diff 時發生錯誤: {e}")
+        return get_pr_diff_fallback()
+
+
+def get_file_content_at_ref(filename, ref):
+    """獲取文件在指定 commit 的內容，不存在時回傳 None"""
+    try:
+        url = f"{GITHUB_API_URL}/repos/{REPO}/contents/{filename}"
+        response = requests.get(url, headers=GITHUB_HEADERS, params={'ref': ref},
+                                timeout=RUN_DEADLINE.request_timeout(10))
+
+        if response.status_code == 200:
+            return base64.b64decode(response.json()['content']).decode('utf-8')
+    except Exception:
+        pass  # 可能是新增或刪除的文件
+    return None
+
+
 def get_file_full_context(filename, pr_data):
     """獲取文件在 PR 前後的完整內容"""
     try:
-        base_content = None
-        head_content = None
-        
-        # 獲取 base 版本的文件內容
-        try:
-            base_url = f"{GITHUB_API_URL}/repos/{REPO}/contents/{filename}"
-            base_params = {'ref': pr_data['base']['sha']}
-            base_response = requests.get(base_url, headers=GITHUB_HEADERS, params=base_params)
-            
-            if base_response.status_code == 200:
-                base_content = base64.b64decode(base_response.json()['content']).decode('utf-8')
-        except Exception:
-            pass  # 可能是新增的文件
-        
-        # 獲取 head 版本的文件內容
-        try:
-            head_url = f"{GITHUB_API_URL}/repos/{REPO}/contents/{filename}"
-            head_params = {'ref': pr_data['head']['sha']}
-            head_response = requests.get(head_url, headers=GITHUB_HEADERS, params=head_params)
-            
-            if head_response.status_code == 200:
-                head_content = base64.b64decode(head_response.json()['content']).decode('utf-8')
-        except Exception:
-            pass  # 可能是刪除的文件
-        
+        # 獲取 base 與 head 版本的文件內容
+        base_content = get_file_content_at_ref(filename, pr_data['base']['sha'])
+        head_content = get_file_content_at_ref(filename, pr_data['head']['sha'])
+
         return {
             'base_content': base_content,
             'head_content': head_content
         }
-        
+
     except Exception as e:
         print(f"    ❌ 無法獲取 {filename} 的完整內容: {e}")
         return None
 
 
+def get_shared_repo_context(pr_data, paths=None):
+    """獲取每次分析共用的倉庫關鍵文件內容（head 版本）"""
+    paths = REVIEW_CONTEXT_FILES if paths is None else paths
+    if not paths:
+        return ""
+
+    sections = []
+    for path in paths:
+        content = get_file_content_at_ref(path, pr_data['head']['sha'])
+        if not content:
+            continue
+        if len(content) > 5000:
+            content = content[:5000] + "\n... (truncated) ..."
+        sections.append(f"--- {path} ---\n{content}")
+
+    if sections:
+        print(f"📚 共用倉庫上下文: {len(sections)} 個文件")
+    return "\n\n".join(sections)
+
+
 def get_pr_diff_fallback():
     """原始版本的 diff 獲取作為後備方案"""
     try:
@@ -252,8 +474,7 @@ def get_pr_diff_fallback():
 
         # 原始的截斷限制
         if len(full_diff) > 25000:
-            print(f"⚠️  Fallback diff 內容過長，進行截斷...")
-            return full_diff[:25000] + "\n\n⚠️ 內容已截斷（fallback 模式）"
+            return truncate_diff(full_diff, 25000, 'fallback 模式', files)
 
         return full_diff
 
@@ -262,15 +483,8 @@ def get_pr_diff_fallback():
         return f"Error fetching PR diff: {str(e)}"
 
 
-def generate_json_with_gemini(diff_text):
-    """階段1: 專門產生乾淨的 JSON 格式"""
-    if not diff_text.strip():
-        return ""
-
-    model = genai.GenerativeModel(GEMINI_MODEL)
-
-    # 階段1: 專注於產生格式正確的 JSON
-    stage1_prompt = """
+# 階段1 的固定指令與 JSON 結構說明，作為可快取的提示詞前綴
+STAGE1_INSTRUCTIONS = """
 你是一個 JSON 產生器。請分析程式碼 diff 並產生有效的 JSON 陣列。
 
 重要規則：
@@ -296,19 +510,184 @@ JSON 結構：
 
 範例（必須遵循此格式）：
 [{"file_path":"test.js","line_number":10,"severity":"Warning","category":"Code Quality","title":"問題標題","description":"問題描述","suggestion":"建議修改","fixed_code":"修復程式碼","original_code":"原始程式碼"}]
+"""
 
-分析以下 diff 並產生 JSON：
+STAGE1_DIFF_HEADER = "分析以下 diff 並產生 JSON：\n\n"
 
-__DIFF_PLACEHOLDER__
-"""
+def build_prompt_prefix(shared_context=""):
+    """組合穩定的提示詞前綴：固定指令 + 共用倉庫上下文"""
+    prefix = STAGE1_INSTRUCTIONS
+    if shared_context:
+        prefix += f"\n倉庫共用上下文（僅供參考，不需要審查）：\n\n{shared_context}\n\n"
+    return prefix
+
+
+def prompt_cache_display_name(prefix):
+    """遠端快取的名稱帶有前綴雜湊，分片可據此確認快取內容與自己的前綴一致"""
+    return f"pr-review-{REPO.replace('/', '-')}-{PR_NUMBER}-{prefix_key(prefix)[:12]}"
+
+
+def call_with_timeout(fn, *args, **kwargs):
+    """在 RUN_DEADLINE.request_timeout() 秒內執行 fn，逾時拋出 TimeoutError
+
+    CachedContent.create / get / delete 不接受 request_options，
+    因此在背景執行緒中呼叫；逾時後該呼叫不會被中斷，但不再阻擋本次執行。
+    """
+    result = {}
+
+    def target():
+        try:
+            result['value'] = fn(*args, **kwargs)
+        except Exception as e:
+            result['error'] = e
+
+    timeout = RUN_DEADLINE.request_timeout()
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f"{getattr(fn, '__name__', 'Gemini 請求')} 超過 {timeout:.0f} 秒")
+    if 'error' in result:
+        raise result['error']
+    return result['value']
+
+
+def count_prompt_tokens(text):
+    """以模型計算 token 數，失敗時改用粗估"""
+    try:
+        return genai.GenerativeModel(GEMINI_MODEL).count_tokens(
+            text, request_options={'timeout': RUN_DEADLINE.request_timeout()}
+        ).total_tokens
+    except Exception:
+        return estimate_tokens(text)
+
+
+def create_gemini_prompt_cache(shared_context="", expected_calls=1):
+    """建立 Gemini context cache，回傳快取名稱；不划算時回傳 None
+
+    只有在至少 PROMPT_CACHE_MIN_CALLS 次階段1 呼叫（分片）共用同一前綴，
+    且前綴達到最小可快取 token 數時才建立；建立者負責在執行結束時呼叫 delete_gemini_prompt_cache。
+    """
+    if PROMPT_CACHE_MODE != 'auto':
+        return None
+    if expected_calls < PROMPT_CACHE_MIN_CALLS:
+        print(f"ℹ️  只有 {expected_calls} 次階段1 呼叫（最少 {PROMPT_CACHE_MIN_CALLS}），不建立 Gemini 快取")
+        return None
+
+    prefix = build_prompt_prefix(shared_context)
+    prefix_tokens = count_prompt_tokens(prefix)
+    if prefix_tokens < PROMPT_CACHE_MIN_TOKENS:
+        print(f"ℹ️  提示詞前綴只有 {prefix_tokens} tokens（最小 {PROMPT_CACHE_MIN_TOKENS}），不建立 Gemini 快取")
+        return None
+
+    try:
+        from google.generativeai import caching
+
+        cache_kwargs = {
+            'model': GEMINI_MODEL,
+            'display_name': prompt_cache_display_name(prefix),
+            'system_instruction': STAGE1_INSTRUCTIONS,
+            'ttl': timedelta(minutes=PROMPT_CACHE_TTL_MINUTES),
+        }
+        if shared_context:
+            cache_kwargs['contents'] = [prefix[len(STAGE1_INSTRUCTIONS):]]
+
+        cached_content = call_with_timeout(caching.CachedContent.create, **cache_kwargs)
+        print(f"✅ 已建立 Gemini 前綴快取 {cached_content.name}（{prefix_tokens} tokens）")
+        return cached_content.name
+    except Exception as e:
+        print(f"⚠️  無法建立 Gemini 前綴快取: {e}")
+        return None
+
+
+def delete_gemini_prompt_cache(name):
+    """刪除 Gemini context cache，避免在 TTL 到期前持續產生儲存費用"""
+    if not name:
+        return
+    try:
+        from google.generativeai import caching
+
+        call_with_timeout(call_with_timeout(caching.CachedContent.get, name).delete)
+        print(f"🗑️  已刪除 Gemini 前綴快取 {name}")
+    except Exception as e:
+        print(f"⚠️  無法刪除 Gemini 前綴快取 {name}: {e}")
+
+
+def load_gemini_cached_model(name, prefix):
+    """載入既有的 Gemini 快取；名稱中的前綴雜湊與本次前綴不符時回傳 None"""
+    try:
+        from google.generativeai import caching
+
+        cached_content = call_with_timeout(caching.CachedContent.get, name)
+        if not cached_content.display_name.endswith(prefix_key(prefix)[:12]):
+            print(f"⚠️  Gemini 快取 {name} 的前綴與本次不同，改用本地快取")
+            return None
+        return genai.GenerativeModel.from_cached_content(cached_content=cached_content)
+    except Exception as e:
+        print(f"⚠️  無法載入 Gemini 前綴快取 {name}，改用本地快取: {e}")
+        return None
+
+
+def get_prompt_cache(shared_context=""):
+    """取得提示詞前綴快取：有共用的 Gemini 快取（PROMPT_CACHE_NAME）時使用它，否則使用本地替身"""
+    prefix = build_prompt_prefix(shared_context)
+
+    cache = None
+    if PROMPT_CACHE_MODE == 'auto' and PROMPT_CACHE_NAME:
+        cache = load_gemini_cached_model(PROMPT_CACHE_NAME, prefix)
+        if cache is not None:
+            print(f"♻️  使用共用的 Gemini 前綴快取 {PROMPT_CACHE_NAME}")
+
+    if cache is None:
+        cache = LocalPromptCache(prefix, genai.GenerativeModel(GEMINI_MODEL).generate_content)
+
+    return cache
 
-    prompt = stage1_prompt.replace("__DIFF_PLACEHOLDER__", diff_text)
+
+def prepare_prompt_cache(shard_count):
+    """以本次 PR 的共用上下文為 shard_count 個分片建立 Gemini 快取，回傳快取名稱（可能為 None）"""
+    if shard_count < PROMPT_CACHE_MIN_CALLS:
+        # 不划算時不必先請求共用上下文
+        print(f"ℹ️  只有 {shard_count} 個分片（最少 {PROMPT_CACHE_MIN_CALLS}），不建立 Gemini 快取")
+        return None
 
     try:
+        shared_context = get_shared_repo_context(get_pr_basic_info())
+    except Exception as e:
+        print(f"⚠️  無法獲取共用倉庫上下文: {e}")
+        shared_context = ""
+    return create_gemini_prompt_cache(shared_context, expected_calls=shard_count)
+
+
+def build_prompt_suffix(diff_text, symbol_context=""):
+    """組合每次呼叫變動的提示詞後綴：相關符號定義 + diff"""
+    suffix = ""
+    if symbol_context:
+        suffix += f"變更所引用的其他文件定義（僅供參考）：\n\n{symbol_context}\n\n"
+    return suffix + STAGE1_DIFF_HEADER + diff_text
+
+
+def generate_json_with_gemini(diff_text, shared_context="", symbol_context=""):
+    """階段1: 專門產生乾淨的 JSON 格式"""
+    if not diff_text.strip():
+        return ""
+
+    try:
+        # 階段1: 專注於產生格式正確的 JSON；固定指令走快取前綴，只送出變動的 diff
+        if PROMPT_CACHE_MODE == 'off':
+            model = genai.GenerativeModel(GEMINI_MODEL)
+            prompt = build_prompt_prefix(shared_context) + build_prompt_suffix(diff_text, symbol_context)
+        else:
+            model = get_prompt_cache(shared_context)
+            prompt = build_prompt_suffix(diff_text, symbol_context)
+
         print("🎯 階段1: 產生 JSON 格式...")
-        response = model.generate_content(prompt)
+        response = model.generate_content(
+            prompt, request_options={'timeout': max(1.0, RUN_DEADLINE.phase_remaining())}
+        )
 
         if not response.text:
+            RUN_DEADLINE.skip("AI 分析（模型沒有回應內容）")
             return ""
 
         # 清理回應
@@ -325,7 +704,9 @@ __DIFF_PLACEHOLDER__
         return cleaned_json
 
     except Exception as e:
+        # 429、5xx、逾時或快取載入失敗都不能當成「沒有問題」，一律列入未審查項目
         print(f"❌ 階段1 錯誤: {e}")
+        RUN_DEADLINE.skip(f"AI 分析（{e}）")
         return ""
 
 
@@ -439,12 +820,12 @@ def validate_and_enhance_json(json_text):
     return validated_items
 
 
-def analyze_diff_with_gemini(diff_text):
+def analyze_diff_with_gemini(diff_text, shared_context="", symbol_context=""):
     """使用 2 階段方法分析 diff"""
     print("🚀 啟動 2 階段 AI 分析...")
     
     # 階段1: 產生 JSON
-    json_text = generate_json_with_gemini(diff_text)
+    json_text = generate_json_with_gemini(diff_text, shared_context, symbol_context)
     if not json_text:
         print("❌ 階段1 失敗，無法產生 JSON")
         return []
@@ -569,7 +950,21 @@ def create_github_style_comment(analysis_data):
     return body
 
 
-def create_summary_comment(analysis_results):
+def format_skipped_section(skipped):
+    """列出未審查（因時間預算、分片失敗或 API 上限而略過）的項目"""
+    if not skipped:
+        return ""
+
+    section = """
+
+### ⏭️ 未審查的項目"""
+    for item in skipped:
+        section += f"""
+- {item}"""
+    return section
+
+
+def create_summary_comment(analysis_results, skipped=None):
     """創建摘要留言"""
 
     if not analysis_results:
@@ -645,6 +1040,8 @@ def create_summary_comment(analysis_results):
 {i}. {severity_emoji} **{item.get('title', 'N/A')}** {category_icon}  
    📁 `{item.get('file_path', 'N/A')}`{f" :line_number: {item.get('line_number')}" if item.get('line_number') else ""}"""
 
+    body += format_skipped_section(skipped)
+
     body += f"""
 
 ---
@@ -657,7 +1054,8 @@ def create_summary_comment(analysis_results):
 def post_comment(body):
     """發佈留言到 PR"""
     url = f"{GITHUB_API_URL}/repos/{REPO}/issues/{PR_NUMBER}/comments"
-    response = requests.post(url, json={'body': body}, headers=GITHUB_HEADERS)
+    response = requests.post(url, json={'body': body}, headers=GITHUB_HEADERS,
+                             timeout=RUN_DEADLINE.request_timeout())
 
     try:
         response.raise_for_status()
@@ -667,28 +1065,31 @@ def post_comment(body):
         return False
 
 
-def post_review_comment(file_path, line_number, body):
-    """發佈程式碼行級別的審查留言（如果可能的話）"""
+def post_review_comment(file_path, line_number, body, side='RIGHT', commit_id=None):
+    """發佈程式碼行級別的審查留言（錨點應先經 resolve_comment_anchor 驗證）"""
 
     # 嘗試發佈 review comment（行級別）
     try:
-        pr_data = get_pr_basic_info()
-        sha = pr_data['head']['sha']
+        if commit_id is None:
+            commit_id = get_pr_basic_info()['head']['sha']
 
         review_payload = {
+            "commit_id": commit_id,
             "body": "AI 程式碼審查 (Enhanced)",
             "event": "COMMENT",
             "comments": [
                 {
                     "path": file_path,
                     "line": line_number,
+                    "side": side,
                     "body": body
                 }
             ]
         }
 
         review_url = f"{GITHUB_API_URL}/repos/{REPO}/pulls/{PR_NUMBER}/reviews"
-        review_response = requests.post(review_url, json=review_payload, headers=GITHUB_HEADERS)
+        review_response = requests.post(review_url, json=review_payload, headers=GITHUB_HEADERS,
+                                        timeout=RUN_DEADLINE.request_timeout())
 
         if review_response.status_code == 200:
             print(f"✅ 成功發佈行級別留言: {file_path}:{line_number}")
@@ -702,61 +1103,181 @@ def post_review_comment(file_path, line_number, body):
         return False
 
 
-if __name__ == "__main__":
+def file_priority(file_data):
+    """文件的分析優先度，0 為一般文件，1 為低優先度文件"""
+    filename = file_data['filename']
+    return 1 if any(re.search(pattern, filename) for pattern in LOW_PRIORITY_PATTERNS) else 0
+
+
+def select_files_for_budget(files, seconds):
+    """依優先度挑選剩餘時間內能分析、且放得進提示詞的文件，其餘記錄為略過"""
+    char_budget = min(seconds * ANALYSIS_CHARS_PER_SECOND, MAX_DIFF_CHARS)
+    selected = []
+    used = 0
+    exhausted = False
+    for file_data in sorted(files, key=file_priority):
+        size = len(file_data.get('patch') or '')
+        # 預算一旦用完，之後（優先度不高於此）的文件全部略過
+        exhausted = exhausted or (bool(selected) and used + size > char_budget)
+        if exhausted:
+            RUN_DEADLINE.skip(f"{'低優先度' if file_priority(file_data) else ''}文件: {file_data['filename']}")
+            continue
+        selected.append(file_data)
+        used += size
+    return selected
+
+
+def run_analysis(files=None):
+    """獲取 diff 與上下文並執行 AI 分析；files 為 None 時分析整個 PR
+
+    每個階段的失敗（例如 GitHub API 逾時）都只記錄為略過項目，不會往外拋出，
+    呼叫端因此一定能走到 post_analysis_results。
+    """
+    RUN_DEADLINE.start_phase('fetch')
+    print("📥 獲取 PR diff 內容...")
     try:
-        print("🚀 開始進行增強版 GitHub 程式碼審查...")
-        print("=" * 70)
+        all_files = get_pr_files() if files is None else files
+        if not all_files:
+            print("ℹ️  沒有需要分析的文件")
+            return []
 
-        # 獲取增強版 diff 和分析
-        print("📥 獲取 PR diff 內容...")
-        diff = get_enhanced_pr_diff()
-        
-        print(f"📄 Diff 內容長度: {len(diff)} 字符")
-        print("🤖 開始 AI 分析...")
-        
-        analysis_results = analyze_diff_with_gemini(diff)
+        # 預算不足時先捨棄低優先度與較大的文件
+        selected = select_files_for_budget(all_files, RUN_DEADLINE.budget_for('analysis'))
+        if files is None and len(selected) == len(all_files):
+            diff = get_enhanced_pr_diff()
+        elif DIFF_ENCODING == 'compact':
+            diff = get_compact_pr_diff(get_pr_basic_info(), selected)
+        else:
+            diff = get_enhanced_file_by_file_diff(get_pr_basic_info(), selected)
+    except Exception as e:
+        print(f"❌ 獲取 PR diff 失敗: {e}")
+        RUN_DEADLINE.skip(f"整個 PR 的分析（無法獲取 diff: {e}）")
+        return []
 
-        if analysis_results:
-            print(f"✅ 分析完成！發現 {len(analysis_results)} 個問題")
+    print(f"📄 Diff 內容長度: {len(diff)} 字符")
 
-            # 先發佈摘要留言
-            summary_body = create_summary_comment(analysis_results)
-            if summary_body:
-                if post_comment(summary_body):
-                    print("✅ 增強版摘要報告已發佈")
-                else:
-                    print("❌ 摘要報告發佈失敗")
+    RUN_DEADLINE.start_phase('context')
 
-            # 發佈每個詳細問題
-            success_count = 0
-            for i, analysis in enumerate(analysis_results, 1):
-                print(f"\n📝 發佈第 {i} 個問題: {analysis.get('title', 'N/A')}")
+    # 共用倉庫上下文放在可快取的提示詞前綴中
+    shared_context = ""
+    if RUN_DEADLINE.has_time_for(5):
+        try:
+            shared_context = get_shared_repo_context(get_pr_basic_info())
+        except Exception as e:
+            print(f"⚠️  無法獲取共用倉庫上下文: {e}")
+    else:
+        RUN_DEADLINE.skip("共用倉庫上下文")
 
-                comment_body = create_github_style_comment(analysis)
+    # 只附上變更 hunk 實際引用到的跨文件定義
+    symbol_context = ""
+    if RUN_DEADLINE.has_time_for(2):
+        try:
+            symbol_index = update_symbol_index(REPO_ROOT, SYMBOL_INDEX_CACHE)
+            # 已完整放在共用前綴中的文件不必再擷取定義
+            shared_paths = [path for path in REVIEW_CONTEXT_FILES if f"--- {path} ---" in shared_context]
+            symbol_context = build_symbol_context(
+                symbol_index, REPO_ROOT, selected, exclude_paths=shared_paths
+            )
+        except Exception as e:
+            print(f"⚠️  無法建立符號上下文: {e}")
+    else:
+        RUN_DEADLINE.skip("跨文件符號上下文")
 
-                # 嘗試行級別留言，失敗則用一般留言
-                line_num = analysis.get('line_number')
-                file_path = analysis.get('file_path')
+    RUN_DEADLINE.start_phase('analysis')
+    if not RUN_DEADLINE.has_time_for(5):
+        RUN_DEADLINE.skip("AI 分析")
+        return []
 
-                if line_num and file_path:
-                    if not post_review_comment(file_path, line_num, comment_body):
-                        # 行級別失敗，使用一般留言
-                        if post_comment(comment_body):
-                            success_count += 1
-                    else:
-                        success_count += 1
-                else:
-                    # 沒有行號，直接用一般留言
+    print("🤖 開始 AI 分析...")
+    return analyze_diff_with_gemini(diff, shared_context, symbol_context)
+
+
+def post_analysis_results(analysis_results):
+    """發佈摘要與每個問題的留言；沒有問題時發佈確認報告
+
+    摘要先發佈且列出所有問題與略過項目，逐項留言則在 posting 預算用完時停止。
+    """
+    RUN_DEADLINE.start_phase('posting')
+    skipped = RUN_DEADLINE.skipped
+
+    if analysis_results:
+        print(f"✅ 分析完成！發現 {len(analysis_results)} 個問題")
+
+        # 在本地決定每個問題的留言方式，避免對不在 diff 中的行號發出注定失敗的請求
+        try:
+            commit_id = get_pr_basic_info()['head']['sha']
+            position_index = build_diff_position_index(get_pr_files())
+        except Exception as e:
+            # 無法建立索引時全部改用一般留言，仍然發佈結果
+            print(f"⚠️  無法建立 diff 位置索引，改用一般留言: {e}")
+            commit_id = None
+            position_index = {}
+        anchors = []
+        for analysis in analysis_results:
+            anchor = resolve_comment_anchor(
+                position_index, analysis.get('file_path'), analysis.get('line_number'),
+                snap_lines=DIFF_ANCHOR_SNAP_LINES
+            )
+            if anchor:
+                analysis['file_path'] = anchor['path']
+                analysis['line_number'] = anchor['line']
+            anchors.append(anchor)
+
+        # 先發佈摘要留言
+        summary_body = create_summary_comment(analysis_results, skipped)
+        if summary_body:
+            if post_comment(summary_body):
+                print("✅ 增強版摘要報告已發佈")
+            else:
+                print("❌ 摘要報告發佈失敗")
+
+        # 發佈每個詳細問題
+        success_count = 0
+        for i, (analysis, anchor) in enumerate(zip(analysis_results, anchors), 1):
+            if not RUN_DEADLINE.has_time_for(3):
+                print(f"⏭️  時間預算用完，剩餘 {len(analysis_results) - i + 1} 個問題僅列於摘要中")
+                break
+
+            print(f"\n📝 發佈第 {i} 個問題: {analysis.get('title', 'N/A')}")
+
+            comment_body = create_github_style_comment(analysis)
+
+            if anchor:
+                if not post_review_comment(anchor['path'], anchor['line'], comment_body,
+                                           side=anchor['side'], commit_id=commit_id):
+                    # 錨點已在本地驗證，僅在 API 異常時才改用一般留言
                     if post_comment(comment_body):
                         success_count += 1
+                else:
+                    success_count += 1
+            else:
+                # 沒有行號或行號不在 diff 中，直接用一般留言
+                if post_comment(comment_body):
+                    success_count += 1
+
+        print("\n" + "=" * 70)
+        print(f"🎉 增強版 GitHub 程式碼審查完成！")
+        print(f"📊 成功發佈 {success_count}/{len(analysis_results)} 個問題")
+        print(f"🔍 使用了增強版 diff 分析，提供更深入的程式碼審查")
+    elif skipped:
+        # 部分工作被略過（時間預算或 API 失敗），不能宣稱沒有問題
+        incomplete_body = f"""## 🤖 AI 程式碼審查報告 (Enhanced)
+
+### ⚠️ 審查未完成
+
+目前未發現問題，但以下項目未能完成審查。{format_skipped_section(skipped)}
+
+---
+
+<sub>🤖 <em>增強版程式碼審查助手</em> | 📅 <em>{datetime.now().strftime("%Y-%m-%d %H:%M")}</em></sub>"""
 
-            print("\n" + "=" * 70)
-            print(f"🎉 增強版 GitHub 程式碼審查完成！")
-            print(f"📊 成功發佈 {success_count}/{len(analysis_results)} 個問題")
-            print(f"🔍 使用了增強版 diff 分析，提供更深入的程式碼審查")
+        if post_comment(incomplete_body):
+            print("✅ 已發佈未完成審查報告")
         else:
-            # 即使沒有問題，也發佈一個簡短的報告
-            no_issues_body = f"""## 🤖 AI 程式碼審查報告 (Enhanced)
+            print("❌ 未完成審查報告發佈失敗")
+    else:
+        # 即使沒有問題，也發佈一個簡短的報告
+        no_issues_body = f"""## 🤖 AI 程式碼審查報告 (Enhanced)
 
 ### ✅ 審查結果
 
@@ -770,11 +1291,134 @@ if __name__ == "__main__":
 ---
 
 <sub>🤖 <em>增強版程式碼審查助手</em> | 📅 <em>{datetime.now().strftime("%Y-%m-%d %H:%M")}</em></sub>"""
-            
-            if post_comment(no_issues_body):
-                print("✅ 未發現問題，已發佈確認報告")
-            else:
-                print("ℹ️  沒有發現需要審查的問題")
+
+        if post_comment(no_issues_body):
+            print("✅ 未發現問題，已發佈確認報告")
+        else:
+            print("ℹ️  沒有發現需要審查的問題")
+
+
+def run_shard(shard_index, shard_count, output_path):
+    """分析單一分片的文件，並把結果寫入 artifact（不發佈留言）"""
+    try:
+        shard_files = partition_files(get_pr_files(), shard_count)[shard_index]
+        print(f"🧩 分片 {shard_index + 1}/{shard_count}: {len(shard_files)} 個文件")
+        analysis_results = run_analysis(shard_files)
+    except Exception as e:
+        # 仍寫出 artifact，讓 merge 步驟在摘要中說明此分片未完成
+        print(f"❌ 分片 {shard_index + 1} 無法獲取文件列表: {e}")
+        RUN_DEADLINE.skip(f"分片 {shard_index + 1}（無法獲取文件列表: {e}）")
+        shard_files = []
+        analysis_results = []
+
+    artifact = {
+        'shard_index': shard_index,
+        'shard_count': shard_count,
+        'files': [file_data['filename'] for file_data in shard_files],
+        'findings': analysis_results,
+        'skipped': RUN_DEADLINE.skipped,
+    }
+    output_dir = os.path.dirname(output_path)
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+    with open(output_path, 'w', encoding='utf-8') as f:
+        json.dump(artifact, f, ensure_ascii=False, indent=2)
+    print(f"💾 分片結果已寫入 {output_path}（{len(analysis_results)} 個問題）")
+
+
+def run_local_shards(shard_count):
+    """在本機以 shard_count 個子行程平行分析各分片，最後合併並發佈一次"""
+    # 子行程共用本行程剩餘的時間預算，並保留合併後發佈留言的時間
+    child_env = dict(os.environ)
+    child_env['RUN_DEADLINE_SECONDS'] = str(
+        max(1.0, RUN_DEADLINE.remaining() - RUN_DEADLINE.PHASE_SHARES['posting'] * RUN_DEADLINE.total_seconds)
+    )
+
+    # 所有分片共用同一個 Gemini 前綴快取，結束後刪除
+    cache_name = prepare_prompt_cache(shard_count)
+    if cache_name:
+        child_env['PROMPT_CACHE_NAME'] = cache_name
+
+    try:
+        run_shard_processes(shard_count, child_env)
+    finally:
+        delete_gemini_prompt_cache(cache_name)
+
+
+def run_shard_processes(shard_count, child_env):
+    """啟動各分片子行程並等待完成，最後合併並發佈一次"""
+    with tempfile.TemporaryDirectory(prefix='pr-review-shards-') as artifact_dir:
+        processes = []
+        for shard_index in range(shard_count):
+            output_path = os.path.join(artifact_dir, f"findings-{shard_index}.json")
+            command = [sys.executable, os.path.abspath(__file__),
+                       '--shard-index', str(shard_index), '--shard-count', str(shard_count),
+                       '--output', output_path]
+            processes.append((output_path, subprocess.Popen(command, env=child_env)))
+
+        artifact_paths = []
+        for output_path, process in processes:
+            if process.wait() != 0:
+                print(f"⚠️  分片子行程失敗（exit code {process.returncode}）: {output_path}")
+            if os.path.exists(output_path):
+                artifact_paths.append(output_path)
+
+        merge_and_post(artifact_paths, shard_count)
+
+
+def merge_and_post(artifact_paths, expected_shard_count=0):
+    """合併分片結果並發佈一次留言；有分片缺少結果時摘要會標示為未完成審查"""
+    findings, missing_shards, skipped = merge_shard_findings(artifact_paths, expected_shard_count)
+    for item in skipped:
+        RUN_DEADLINE.skip(item)
+    for shard_index in missing_shards:
+        RUN_DEADLINE.skip(f"分片 {shard_index + 1}（未回傳結果）")
+    post_analysis_results(findings)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='AI Pull Request 程式碼審查')
+    parser.add_argument('--shard-index', type=int, help='只分析此分片（0 起算），結果寫入 --output')
+    parser.add_argument('--shard-count', type=int, default=int(os.environ.get('SHARD_COUNT', '1')),
+                        help='分片總數')
+    parser.add_argument('--output', default='findings.json', help='分片結果 artifact 路徑')
+    parser.add_argument('--merge', nargs='+', metavar='ARTIFACT', help='合併分片結果並發佈留言')
+    parser.add_argument('--local-shards', type=int, metavar='N', help='在本機以 N 個子行程分片分析')
+    parser.add_argument('--create-prompt-cache', action='store_true',
+                        help='建立供各分片共用的 Gemini 前綴快取，並輸出快取名稱（寫入 GITHUB_OUTPUT 的 cache_name）')
+    args = parser.parse_args()
+
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shard_count:
+        parser.error('--shard-index 必須介於 0 與 --shard-count - 1 之間')
+    return args
+
+
+if __name__ == "__main__":
+    try:
+        args = parse_args()
+        print("🚀 開始進行增強版 GitHub 程式碼審查...")
+        print("=" * 70)
+
+        if args.create_prompt_cache:
+            cache_name = prepare_prompt_cache(args.shard_count) or ''
+            print(f"cache_name={cache_name}")
+            if os.environ.get('GITHUB_OUTPUT'):
+                with open(os.environ['GITHUB_OUTPUT'], 'a', encoding='utf-8') as f:
+                    f.write(f"cache_name={cache_name}\n")
+        elif args.merge:
+            try:
+                merge_and_post(args.merge, args.shard_count)
+            finally:
+                # 共用快取由 merge 步驟負責清理
+                delete_gemini_prompt_cache(PROMPT_CACHE_NAME)
+        elif args.shard_index is not None:
+            # 分片不發佈留言，分析可以用到截止時間
+            RUN_DEADLINE = RunDeadline(RUN_DEADLINE_SECONDS, phases=RunDeadline.SHARD_PHASES)
+            run_shard(args.shard_index, args.shard_count, args.output)
+        elif args.local_shards:
+            run_local_shards(args.local_shards)
+        else:
+            post_analysis_results(run_analysis())
 
     except Exception as e:
         print(f"❌ 發生錯誤: {e}")
@@ -0,0 +1,25 @@
+"""提示詞前綴快取的本地替身，不依賴任何模型 SDK"""
+import hashlib
+
+
+def prefix_key(prefix):
+    """前綴內容的 SHA-256，用來辨識相同的前綴"""
+    return hashlib.sha256(prefix.encode('utf-8')).hexdigest()
+
+
+class LocalPromptCache:
+    """本地的前綴快取替身：保存穩定前綴，每次呼叫只需提供變動的後綴
+
+    在無法使用 Gemini context caching 時（或測試中）使用；
+    generate_fn 為任何接收完整提示詞並回傳帶有 .text 回應的函式。
+    """
+
+    def __init__(self, prefix, generate_fn):
+        self.prefix = prefix
+        self.prefix_hash = prefix_key(prefix)
+        self.calls = 0
+        self._generate_fn = generate_fn
+
+    def generate_content(self, suffix, **kwargs):
+        self.calls += 1
+        return self._generate_fn(self.prefix + suffix, **kwargs)
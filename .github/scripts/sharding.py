@@ -0,0 +1,78 @@
+"""分片審查：變更文件的確定性分配與分片結果合併，不依賴任何模型 SDK"""
+import hashlib
+import json
+
+SEVERITY_RANK = {'Critical': 0, 'Warning': 1, 'Info': 2}
+
+
+def partition_files(files, shard_count):
+    """依 diff 大小加權，把變更文件確定性地分配到 shard_count 個分片
+
+    由大到小排序（同大小時以檔名的穩定雜湊決定順序），每次放入目前負載最小的分片；
+    相同的文件列表在任何機器上都會得到相同的分片結果。
+    """
+    def weight(file_data):
+        return file_data.get('additions', 0) + file_data.get('deletions', 0) + 1
+
+    def stable_hash(file_data):
+        return hashlib.sha1(file_data['filename'].encode('utf-8')).hexdigest()
+
+    shards = [[] for _ in range(shard_count)]
+    loads = [0] * shard_count
+    for file_data in sorted(files, key=lambda f: (-weight(f), stable_hash(f))):
+        target = min(range(shard_count), key=lambda i: (loads[i], i))
+        shards[target].append(file_data)
+        loads[target] += weight(file_data)
+    return shards
+
+
+def finding_key(item):
+    """同文件、同行號、同標題（忽略大小寫與空白）視為同一個問題"""
+    return (
+        item.get('file_path'),
+        item.get('line_number'),
+        ' '.join(str(item.get('title', '')).lower().split()),
+    )
+
+
+def merge_shard_findings(artifact_paths, expected_shard_count=0):
+    """合併各分片的 artifact 並去除重複的問題（同文件、同行號、同標題只保留最嚴重的一個）
+
+    回傳 (findings, missing_shards, skipped)：missing_shards 為未回傳結果的分片索引，
+    呼叫端據此發佈未完成審查的報告，而不是把部分結果誤報為沒有問題；
+    skipped 為各分片略過的項目，每個分片都會記錄的項目（例如 3000 個文件的上限）只保留一次。
+    """
+    artifacts = []
+    for path in artifact_paths:
+        try:
+            with open(path, encoding='utf-8') as f:
+                artifacts.append(json.load(f))
+        except (OSError, ValueError) as e:
+            print(f"⚠️  無法讀取分片結果 {path}: {e}")
+
+    # 完全沒有結果時至少視為缺少一個分片
+    shard_count = max([expected_shard_count, 0 if artifacts else 1]
+                      + [a.get('shard_count', 0) for a in artifacts])
+    received = {a.get('shard_index') for a in artifacts}
+    missing_shards = [i for i in range(shard_count) if i not in received]
+    if missing_shards or not artifacts:
+        print(f"⚠️  只收到 {len(artifacts)}/{shard_count} 個分片的結果")
+
+    artifacts.sort(key=lambda a: a.get('shard_index', 0))
+    skipped = []
+    merged = {}
+    for artifact in artifacts:
+        for item in artifact.get('skipped', []):
+            if item not in skipped:
+                skipped.append(item)
+        for item in artifact.get('findings', []):
+            key = finding_key(item)
+            existing = merged.get(key)
+            if existing is None or (SEVERITY_RANK.get(item.get('severity'), 2)
+                                    < SEVERITY_RANK.get(existing.get('severity'), 2)):
+                merged[key] = item
+
+    findings = list(merged.values())
+    total = sum(len(a.get('findings', [])) for a in artifacts)
+    print(f"🔀 合併 {len(artifacts)} 個分片: {total} 個問題，去重後 {len(findings)} 個")
+    return findings, missing_shards, skipped
@@ -0,0 +1,290 @@
+"""倉庫符號索引：JS/TS/Python 的定義與 import 關係，依 blob SHA 增量更新"""
+import ast
+import json
+import os
+import re
+import subprocess
+
+SYMBOL_INDEX_VERSION = 2
+
+JS_EXTENSIONS = ('.js', '.jsx', '.ts', '.tsx', '.mjs', '.cjs')
+PY_EXTENSIONS = ('.py',)
+
+# 每個定義最多擷取的行數，避免單一大型函式佔滿上下文
+MAX_DEFINITION_LINES = 60
+
+# 頂層 JS/TS 定義: function / class / const|let|var，可帶 export、export default、async
+JS_DEFINITION_PATTERN = re.compile(
+    r'^(?:export\s+(?:default\s+)?)?(?:async\s+)?'
+    r'(?:(function\*?|class|interface|type|enum)\s+([A-Za-z_$][\w$]*)'
+    r'|(const|let|var)\s+([A-Za-z_$][\w$]*)\s*[=:])'
+)
+JS_IMPORT_PATTERNS = [
+    re.compile(r'''^\s*import\s[^'"]*?\bfrom\s*['"]([^'"]+)['"]''', re.MULTILINE),
+    re.compile(r'''^\s*import\s*['"]([^'"]+)['"]''', re.MULTILINE),
+    re.compile(r'''^\s*export\s[^'"]*?\bfrom\s*['"]([^'"]+)['"]''', re.MULTILINE),
+    re.compile(r'''\brequire\(\s*['"]([^'"]+)['"]\s*\)'''),
+]
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_$][\w$]*')
+# 需要 { } 主體的定義種類；其餘（const/let/var/type）可以是單行宣告
+JS_BODY_KINDS = ('function', 'function*', 'class', 'interface', 'enum')
+# 行尾出現這些符號時，宣告在下一行繼續
+JS_CONTINUATION_SUFFIXES = ('=', '=>', ',', '?', ':', '+', '-', '*', '/', '&&', '||', '(', '[', '{', '.')
+
+
+def list_tracked_blobs(repo_root):
+    """列出倉庫中受追蹤的 JS/TS/Python 文件及其 blob SHA"""
+    output = subprocess.run(
+        ['git', 'ls-files', '-s'], cwd=repo_root, capture_output=True, text=True, check=True
+    ).stdout
+
+    blobs = {}
+    for line in output.splitlines():
+        # 格式: <mode> <sha> <stage>\t<path>
+        meta, _, path = line.partition('\t')
+        if path.endswith(JS_EXTENSIONS + PY_EXTENSIONS):
+            blobs[path] = meta.split()[1]
+    return blobs
+
+
+def _find_js_definition_end(lines, start, kind):
+    """以括號平衡找出 JS 定義結束的行（0-based，包含）
+
+    只有 { 或 [（以及 = 之後的 (）算是開啟定義主體；函式參數列的 () 不算，
+    因此 `function foo()` 換行後才出現的 { 仍屬於此定義。
+    沒有開啟主體的 const/let/var/type 宣告在自己那一行結束。
+    """
+    depth = 0
+    opened = False
+    needs_body = kind in JS_BODY_KINDS
+    last = min(len(lines), start + MAX_DEFINITION_LINES) - 1
+
+    for i in range(start, last + 1):
+        # 粗略去掉字串與行註解，避免其中的括號干擾計數
+        code = re.sub(r'''(["'`])(?:\\.|(?!\1).)*\1''', '', lines[i]).split('//')[0]
+        for j, char in enumerate(code):
+            if char in '{[':
+                depth += 1
+                opened = True
+            elif char == '(':
+                depth += 1
+                if not needs_body and i == start and '=' in code[:j]:
+                    opened = True
+            elif char in '})]':
+                depth -= 1
+
+        continues = code.rstrip().endswith(JS_CONTINUATION_SUFFIXES)
+        if depth <= 0 and not continues and (opened or not needs_body):
+            return i
+    return last
+
+
+def parse_js_symbols(source):
+    """解析 JS/TS 原始碼的頂層定義與 import"""
+    lines = source.split('\n')
+    definitions = []
+
+    for i, line in enumerate(lines):
+        match = JS_DEFINITION_PATTERN.match(line)
+        if not match:
+            continue
+        kind = match.group(1) or match.group(3)
+        name = match.group(2) or match.group(4)
+        end = _find_js_definition_end(lines, i, kind)
+        definitions.append({'name': name, 'kind': kind, 'start': i + 1, 'end': end + 1})
+
+    imports = []
+    for pattern in JS_IMPORT_PATTERNS:
+        for spec in pattern.findall(source):
+            if spec not in imports:
+                imports.append(spec)
+
+    return {'definitions': definitions, 'imports': imports}
+
+
+def parse_python_symbols(source):
+    """解析 Python 原始碼的頂層定義與 import"""
+    try:
+        tree = ast.parse(source)
+    except (SyntaxError, ValueError):
+        return {'definitions': [], 'imports': []}
+
+    definitions = []
+    imports = []
+    for node in tree.body:
+        if isinstance(node, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+            kind = 'class' if isinstance(node, ast.ClassDef) else 'def'
+            start = node.decorator_list[0].lineno if node.decorator_list else node.lineno
+            definitions.append({'name': node.name, 'kind': kind, 'start': start, 'end': node.end_lineno})
+        elif isinstance(node, (ast.Assign, ast.AnnAssign)):
+            targets = node.targets if isinstance(node, ast.Assign) else [node.target]
+            for target in targets:
+                if isinstance(target, ast.Name):
+                    definitions.append({'name': target.id, 'kind': 'var',
+                                        'start': node.lineno, 'end': node.end_lineno})
+        elif isinstance(node, ast.Import):
+            imports.extend(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module:
+            imports.append('.' * node.level + node.module)
+
+    return {'definitions': definitions, 'imports': imports}
+
+
+def parse_symbols(path, source):
+    """依副檔名選擇解析器"""
+    if path.endswith(PY_EXTENSIONS):
+        return parse_python_symbols(source)
+    return parse_js_symbols(source)
+
+
+def load_symbol_index(cache_path):
+    """讀取快取的符號索引，版本不符或損壞時回傳空索引"""
+    try:
+        with open(cache_path, encoding='utf-8') as f:
+            cached = json.load(f)
+        if cached.get('version') == SYMBOL_INDEX_VERSION:
+            return cached
+    except (OSError, ValueError):
+        pass
+    return {'version': SYMBOL_INDEX_VERSION, 'files': {}}
+
+
+def save_symbol_index(index, cache_path):
+    """寫入符號索引快取"""
+    cache_dir = os.path.dirname(cache_path)
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, 'w', encoding='utf-8') as f:
+        json.dump(index, f, ensure_ascii=False)
+
+
+def update_symbol_index(repo_root, cache_path):
+    """增量更新符號索引：blob SHA 未變的文件直接沿用快取結果"""
+    index = load_symbol_index(cache_path)
+    cached_files = index['files']
+    files = {}
+    parsed = 0
+
+    for path, sha in list_tracked_blobs(repo_root).items():
+        entry = cached_files.get(path)
+        if entry and entry.get('sha') == sha:
+            files[path] = entry
+            continue
+        try:
+            with open(os.path.join(repo_root, path), encoding='utf-8') as f:
+                source = f.read()
+        except (OSError, UnicodeDecodeError):
+            continue
+        files[path] = {'sha': sha, **parse_symbols(path, source)}
+        parsed += 1
+
+    index['files'] = files
+    print(f"🧭 符號索引: {len(files)} 個文件，重新解析 {parsed} 個，沿用快取 {len(files) - parsed} 個")
+
+    try:
+        save_symbol_index(index, cache_path)
+    except OSError as e:
+        print(f"⚠️  無法寫入符號索引快取: {e}")
+    return index
+
+
+def resolve_import(from_path, spec, known_paths):
+    """把 import 路徑解析為倉庫中的文件，找不到（例如第三方套件）時回傳 None"""
+    if from_path.endswith(PY_EXTENSIONS):
+        level = len(spec) - len(spec.lstrip('.'))
+        module_path = spec.lstrip('.').replace('.', '/')
+        if level:
+            base = os.path.dirname(from_path)
+            for _ in range(level - 1):
+                base = os.path.dirname(base)
+            module_path = os.path.join(base, module_path)
+        candidates = [module_path + '.py', module_path + '/__init__.py']
+    else:
+        if not spec.startswith('.'):
+            return None
+        module_path = os.path.normpath(os.path.join(os.path.dirname(from_path), spec))
+        candidates = [module_path] + [module_path + ext for ext in JS_EXTENSIONS]
+        candidates += [f"{module_path}/index{ext}" for ext in JS_EXTENSIONS]
+
+    for candidate in candidates:
+        candidate = os.path.normpath(candidate)
+        if candidate in known_paths:
+            return candidate
+    return None
+
+
+def changed_identifiers(patch):
+    """擷取 patch 中新增/刪除行所使用的識別字"""
+    identifiers = set()
+    for line in (patch or '').split('\n'):
+        if line.startswith(('+', '-')) and not line.startswith(('+++', '---')):
+            identifiers.update(IDENTIFIER_PATTERN.findall(line[1:]))
+    return identifiers
+
+
+def build_symbol_context(index, repo_root, changed_files, max_chars=20000, exclude_paths=()):
+    """只挑出變更 hunk 所引用、定義在其他文件中的符號，組成精簡的跨文件上下文
+
+    changed_files 為 GitHub PR files API 的回傳格式（需有 filename 與 patch）。
+    被變更文件 import 的文件優先，其次才是倉庫中唯一定義該名稱的文件。
+    exclude_paths 中的文件（例如已完整放在共用前綴中的文件）不會再重複擷取定義。
+    """
+    files = index['files']
+    known_paths = set(files)
+
+    # 名稱 -> 定義該名稱的文件列表，用於未經 import 直接引用的情況
+    defined_in = {}
+    for path, entry in files.items():
+        for definition in entry['definitions']:
+            defined_in.setdefault(definition['name'], []).append(path)
+
+    selected = []
+    seen = set()
+    for file_data in changed_files:
+        path = file_data['filename']
+        identifiers = changed_identifiers(file_data.get('patch'))
+        if not identifiers:
+            continue
+
+        imported = []
+        for spec in files.get(path, {}).get('imports', []):
+            target = resolve_import(path, spec, known_paths)
+            if target and target != path:
+                imported.append(target)
+
+        for name in sorted(identifiers):
+            owners = [p for p in defined_in.get(name, []) if p != path and p not in exclude_paths]
+            preferred = [p for p in owners if p in imported]
+            targets = preferred or (owners if len(owners) == 1 else [])
+            for target in targets:
+                for definition in files[target]['definitions']:
+                    key = (target, definition['name'], definition['start'])
+                    if definition['name'] == name and key not in seen:
+                        seen.add(key)
+                        selected.append((0 if preferred else 1, target, definition))
+
+    if not selected:
+        return ""
+
+    sections = []
+    total = 0
+    source_cache = {}
+    for _, target, definition in sorted(selected, key=lambda item: item[0]):
+        if target not in source_cache:
+            try:
+                with open(os.path.join(repo_root, target), encoding='utf-8') as f:
+                    source_cache[target] = f.read().split('\n')
+            except (OSError, UnicodeDecodeError):
+                source_cache[target] = []
+        snippet = '\n'.join(source_cache[target][definition['start'] - 1:definition['end']])
+        if not snippet.strip():
+            continue
+
+        section = f"--- {target}:{definition['start']}-{definition['end']} ({definition['name']}) ---\n{snippet}"
+        if total + len(section) > max_chars:
+            break
+        sections.append(section)
+        total += len(section)
+
+    print(f"🔗 跨文件符號上下文: {len(sections)} 個定義，{total} 字符")
+    return "\n\n".join(sections)
@@ -0,0 +1,53 @@
+from diff_encoding import compact_hunk, encode_file_compact, is_whitespace_only_hunk, split_patch_hunks
+
+
+def encode(filename, patch, status='modified'):
+    return encode_file_compact(
+        {'filename': filename, 'status': status, 'additions': 1, 'deletions': 1, 'patch': patch}
+    )
+
+
+def test_python_dedent_is_not_whitespace_only():
+    lines = [' if x:', '-    foo()', '+foo()']
+    assert not is_whitespace_only_hunk(lines, 'app.py')
+    assert encode('app.py', "@@ -1,2 +1,2 @@\n if x:\n-    foo()\n+foo()")[0] is not None
+
+
+def test_yaml_indentation_change_is_not_whitespace_only():
+    assert not is_whitespace_only_hunk(['-  key: 1', '+    key: 1'], '.github/workflows/ci.yml')
+
+
+def test_whitespace_inside_a_line_is_meaningful():
+    assert not is_whitespace_only_hunk(["-x = 'a b'", "+x = 'ab'"], 'a.js')
+
+
+def test_reindent_and_trailing_whitespace_are_whitespace_only():
+    assert is_whitespace_only_hunk(['-    x = 1;  ', '+  x = 1;'], 'a.js')
+    assert is_whitespace_only_hunk(['-x = 1  ', '+x = 1', '+'], 'a.py')
+    assert encode('a.js', "@@ -1,1 +1,1 @@\n-    x = 1;\n+  x = 1;") == (None, 'whitespace only')
+
+
+def test_compact_hunk_reanchors_line_numbers():
+    hunks = split_patch_hunks("@@ -1,9 +1,10 @@\n a\n b\n c\n-x = 1\n+x = 2\n d\n e\n f\n g\n+h")
+    old_start, new_start, lines = hunks[0]
+    assert compact_hunk(old_start, new_start, lines, context=1) == [
+        '@@ -3 +3 @@', ' c', '-x = 1', '+x = 2', ' d',
+        '@@ -8 +8 @@', ' g', '+h',
+    ]
+
+
+def test_compact_hunk_without_context():
+    assert compact_hunk(10, 12, [' a', '-b', '+c', ' d'], context=0) == ['@@ -11 +13 @@', '-b', '+c']
+
+
+def test_status_codes_are_distinct():
+    patch = "@@ -1,1 +1,1 @@\n-a\n+b"
+    assert encode('a.js', patch, 'removed')[0].startswith('## a.js D ')
+    assert encode('a.js', patch, 'renamed')[0].startswith('## a.js R ')
+    assert encode('a.js', patch, 'copied')[0].startswith('## a.js C ')
+    assert encode('a.js', patch, 'changed')[0].startswith('## a.js T ')
+
+
+def test_pure_rename_is_dropped():
+    data = {'filename': 'b.js', 'previous_filename': 'a.js', 'status': 'renamed', 'additions': 0, 'deletions': 0}
+    assert encode_file_compact(data) == (None, 'rename only')
@@ -0,0 +1,62 @@
+from diff_index import build_diff_position_index, parse_patch_lines, resolve_comment_anchor
+
+PATCH = (
+    "@@ -1,4 +1,5 @@\n a\n-b\n+B\n+C\n c\n d\n"
+    "@@ -20,2 +21,2 @@\n x\n-y\n+Y\n\\ No newline at end of file"
+)
+
+
+def make_index(patch=PATCH, filename='src/App.js'):
+    return build_diff_position_index([{'filename': filename, 'patch': patch}])
+
+
+def test_parse_patch_lines_tracks_both_sides():
+    lines = parse_patch_lines("@@ -3,2 +3,2 @@\n keep\n-old\n+new")
+    assert lines == [
+        ('LEFT', 3, 'context'), ('RIGHT', 3, 'context'),
+        ('LEFT', 4, 'del'), ('RIGHT', 4, 'add'),
+    ]
+
+
+def test_context_line_is_used_as_is():
+    assert resolve_comment_anchor(make_index(), 'src/App.js', 4) == \
+        {'path': 'src/App.js', 'line': 4, 'side': 'RIGHT'}
+
+
+def test_changed_line_is_used_as_is():
+    assert resolve_comment_anchor(make_index(), 'src/App.js', 22)['line'] == 22
+
+
+def test_near_miss_snaps_to_nearest_changed_line():
+    assert resolve_comment_anchor(make_index(), 'src/App.js', 19)['line'] == 22
+    assert resolve_comment_anchor(make_index(), 'src/App.js', 6, snap_lines=3)['line'] == 3
+
+
+def test_line_outside_snap_window_becomes_plain_comment():
+    assert resolve_comment_anchor(make_index(), 'src/App.js', 12) is None
+    assert resolve_comment_anchor(make_index(), 'src/App.js', 6, snap_lines=2) is None
+
+
+def test_path_prefixes_are_stripped():
+    for path in ('./src/App.js', 'a/src/App.js', 'b/src/App.js'):
+        assert resolve_comment_anchor(make_index(), path, 2)['path'] == 'src/App.js'
+    assert resolve_comment_anchor(make_index(), 'other.js', 2) is None
+
+
+def test_pure_deletion_hunk_has_no_changed_right_lines():
+    index = make_index("@@ -5,3 +5,2 @@\n a\n-b\n c")
+    assert index['src/App.js']['LEFT'][6] == 'del'
+    assert resolve_comment_anchor(index, 'src/App.js', 5)['line'] == 5
+    assert resolve_comment_anchor(index, 'src/App.js', 7) is None
+    assert resolve_comment_anchor(index, 'src/App.js', 6, side='LEFT') == \
+        {'path': 'src/App.js', 'line': 6, 'side': 'LEFT'}
+
+
+def test_file_without_patch_is_not_commentable():
+    index = build_diff_position_index([{'filename': 'logo.png'}])
+    assert index['logo.png'] == {'LEFT': {}, 'RIGHT': {}}
+    assert resolve_comment_anchor(index, 'logo.png', 1) is None
+
+
+def test_missing_line_number_is_not_anchored():
+    assert resolve_comment_anchor(make_index(), 'src/App.js', None) is None
@@ -0,0 +1,40 @@
+from prompt_cache import LocalPromptCache, prefix_key
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+def test_prefix_is_reused_and_only_suffix_changes():
+    prompts = []
+
+    def generate(prompt, **kwargs):
+        prompts.append(prompt)
+        return FakeResponse('[]')
+
+    cache = LocalPromptCache('INSTRUCTIONS\n', generate)
+    cache.generate_content('diff 1')
+    cache.generate_content('diff 2')
+
+    assert prompts == ['INSTRUCTIONS\ndiff 1', 'INSTRUCTIONS\ndiff 2']
+    assert cache.calls == 2
+    assert cache.prefix_hash == prefix_key('INSTRUCTIONS\n')
+
+
+def test_generate_kwargs_are_passed_through():
+    received = {}
+
+    def generate(prompt, **kwargs):
+        received.update(kwargs)
+        return FakeResponse('[]')
+
+    response = LocalPromptCache('P', generate).generate_content('S', request_options={'timeout': 5})
+
+    assert response.text == '[]'
+    assert received == {'request_options': {'timeout': 5}}
+
+
+def test_different_prefixes_have_different_keys():
+    assert prefix_key('a') != prefix_key('b')
+    assert prefix_key('a') == prefix_key('a')
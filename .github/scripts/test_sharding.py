@@ -0,0 +1,61 @@
+import json
+
+from sharding import merge_shard_findings, partition_files
+
+
+def changed_files():
+    return [{'filename': f'src/file{i}.js', 'additions': i * 7 % 13, 'deletions': i % 3}
+            for i in range(20)]
+
+
+def names(shards):
+    return [[f['filename'] for f in shard] for shard in shards]
+
+
+def write_artifact(tmp_path, shard_index, shard_count, findings, skipped=()):
+    path = tmp_path / f'findings-{shard_index}.json'
+    path.write_text(json.dumps({
+        'shard_index': shard_index, 'shard_count': shard_count,
+        'files': [], 'findings': findings, 'skipped': list(skipped),
+    }))
+    return str(path)
+
+
+def test_partition_does_not_depend_on_input_order():
+    files = changed_files()
+    assert names(partition_files(files, 3)) == names(partition_files(list(reversed(files)), 3))
+
+
+def test_every_file_is_in_exactly_one_shard():
+    files = changed_files()
+    assigned = [name for shard in names(partition_files(files, 4)) for name in shard]
+    assert sorted(assigned) == sorted(f['filename'] for f in files)
+
+
+def test_duplicate_findings_keep_the_most_severe(tmp_path):
+    info = {'file_path': 'a.js', 'line_number': 3, 'title': 'Null  check', 'severity': 'Info'}
+    critical = {'file_path': 'a.js', 'line_number': 3, 'title': 'null check', 'severity': 'Critical'}
+    other = {'file_path': 'a.js', 'line_number': 9, 'title': 'null check', 'severity': 'Warning'}
+    paths = [write_artifact(tmp_path, 0, 2, [info, other]), write_artifact(tmp_path, 1, 2, [critical])]
+
+    findings, missing, _ = merge_shard_findings(paths)
+
+    assert missing == []
+    assert sorted(f['severity'] for f in findings) == ['Critical', 'Warning']
+
+
+def test_missing_shards_are_reported(tmp_path):
+    paths = [write_artifact(tmp_path, 1, 3, []), str(tmp_path / 'absent.json')]
+
+    _, missing, _ = merge_shard_findings(paths)
+
+    assert missing == [0, 2]
+    assert merge_shard_findings([], expected_shard_count=2)[1] == [0, 1]
+
+
+def test_skipped_entries_shared_by_shards_are_listed_once(tmp_path):
+    overflow = 'PR 文件列表（超過 3000 個文件）'
+    paths = [write_artifact(tmp_path, 0, 2, [], [overflow, '文件: a.js']),
+             write_artifact(tmp_path, 1, 2, [], [overflow])]
+
+    assert merge_shard_findings(paths)[2] == [overflow, '文件: a.js']
@@ -0,0 +1,39 @@
+from symbol_index import build_symbol_context, parse_js_symbols
+
+
+def extents(source):
+    return {d['name']: (d['start'], d['end']) for d in parse_js_symbols(source)['definitions']}
+
+
+def test_function_with_brace_on_next_line_includes_body():
+    source = "function foo()\n{\n  return 1;\n}\n"
+    assert extents(source)['foo'] == (1, 4)
+
+
+def test_const_without_semicolon_ends_on_its_own_line():
+    source = "import x from 'y'\n\n\n\nconst a = 5\nconst b = 6\n"
+    assert extents(source) == {'a': (5, 5), 'b': (6, 6)}
+
+
+def test_multiline_object_and_call_declarations():
+    source = (
+        "const config = {\n  a: 1,\n};\n"
+        "export const db = getFirestore(\n  app\n);\n"
+        "export const toggle = (key) => {\n  return key;\n};\n"
+        "const sum = (a, b) =>\n  a + b\n"
+    )
+    assert extents(source) == {
+        'config': (1, 3), 'db': (4, 6), 'toggle': (7, 9), 'sum': (10, 11),
+    }
+
+
+def test_symbol_context_skips_files_already_in_shared_prefix(tmp_path):
+    (tmp_path / 'lib.js').write_text("export const helper = () => 1;\n")
+    index = {'files': {
+        'lib.js': {'sha': '1', 'imports': [], **parse_js_symbols("export const helper = () => 1;\n")},
+        'app.js': {'sha': '2', 'imports': ['./lib'], 'definitions': []},
+    }}
+    changed = [{'filename': 'app.js', 'patch': "@@ -1 +1 @@\n-x()\n+helper()"}]
+
+    assert 'helper' in build_symbol_context(index, str(tmp_path), changed)
+    assert build_symbol_context(index, str(tmp_path), changed, exclude_paths=['lib.js']) == ""